@@ -2,35 +2,124 @@ __author__ = "Vadym Stupakov"
 __maintainer__ = "Vadym Stupakov"
 __email__ = "vadim.stupakov@gmail.com"
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
+import io
+from itertools import chain, islice
+import mmap
+from operator import itemgetter, length_hint
+import os
+import pickle
 import shutil
-from typing import Any, Iterable
+import struct
+import threading
+from types import FunctionType
+from typing import Any, Iterable, Iterator, Optional, Union
 import lmdb
 from pathlib import Path
-import dill
+
+
+# the first byte of every stored value tells which serializer produced the rest
+_PICKLE_TAG = b"P"
+_DILL_TAG = b"D"
+_BYTES_TAG = b"B"
+
+_MAIN_MODULES = ("__main__", "__mp_main__")
+
+
+class _Pickler(pickle.Pickler):
+    def reducer_override(self, obj):
+        # pickle stores classes and functions by reference, so ones defined in __main__ (scripts, notebooks)
+        # can't be loaded by another program: leave them to dill, which stores them by value.
+        # Spawn and forkserver workers run the script as __mp_main__, which no other program has either
+        if isinstance(obj, (type, FunctionType)) and obj.__module__ in _MAIN_MODULES:
+            raise pickle.PicklingError(f"{obj!r} is defined in __main__")
+        return NotImplemented
 
 
 def _serialize(obj) -> bytes:
-    data = dill.dumps(obj, protocol=dill.HIGHEST_PROTOCOL)
+    if type(obj) is bytes:
+        # raw blobs are stored as they are: pickling them first would cost another full copy on every write
+        return _BYTES_TAG + obj
+
+    try:
+        buffer = io.BytesIO()
+        buffer.write(_PICKLE_TAG)
+        _Pickler(buffer, protocol=pickle.HIGHEST_PROTOCOL).dump(obj)
+        data = buffer.getvalue()
+    except (pickle.PicklingError, AttributeError, TypeError):
+        # dill is much slower, so it is used only for objects pickle can't handle or can store by reference only:
+        # lambdas, local classes, anything defined in __main__, etc.
+        # It is imported on first use, so readers and writers of plain objects never pay for importing it
+        import dill
+        data = _DILL_TAG + dill.dumps(obj, protocol=dill.HIGHEST_PROTOCOL)
     return data
 
 
-def _deserialize(data: bytes) -> Any:
-    obj = dill.loads(data)
+def _deserialize(data: Union[bytes, memoryview]) -> Any:
+    # indexing yields an int, slicing a memoryview would allocate a new view just to compare one byte
+    tag = data[0]
+    if tag == _PICKLE_TAG[0]:
+        obj = pickle.loads(data[1:])
+    elif tag == _BYTES_TAG[0]:
+        # a view into the memory map is valid only while its transaction is open, so hand out a copy
+        obj = bytes(data[1:])
+    else:
+        import dill
+        obj = dill.loads(data[1:])
     return obj
 
 
+# fixed-width big-endian keys sort in index order, which lets writers append instead of doing B-tree inserts.
+# MDB_INTEGERKEY is not used: it needs native-endian keys, which would tie the files to the CPU that wrote them,
+# while the default comparison of 8 big-endian bytes already orders them as integers.
+# A pre-compiled Struct packs a key in a single C call, without the lookup and argument parsing of int.to_bytes
+_KEY_STRUCT = struct.Struct(">Q")
+_encode_key = _KEY_STRUCT.pack
+
+# the version of the key and value format, stored under a key which isn't 8 bytes long, so it is never an index.
+# It is written after all items, so an interrupted dump has no marker either
+_FORMAT_KEY = b"lmdb_cache:format"
+_FORMAT_VERSION = b"2"
+
+
+def _check_format(env: lmdb.Environment, db_path: Path) -> None:
+    with env.begin() as txn:
+        version = txn.get(_FORMAT_KEY)
+    if version != _FORMAT_VERSION:
+        raise RuntimeError(f"lmdb was written in an incompatible format, dump it again with overwrite=True: {db_path}")
+
+
 def lmdb_exists(p: Path) -> bool:
-    if p.exists():
-        if p.is_dir():
-            files = {f.name for f in p.iterdir() if f.is_file()}
-            db_files = {"data.mdb", "lock.mdb"}
-            return db_files.issubset(files)
-        else:
-            raise NotADirectoryError(p)
-    else:
+    # a single directory read answers everything: scandir fails for a missing path or a file,
+    # and its entries know their type without a stat call per file
+    try:
+        with os.scandir(p.as_posix()) as entries:
+            files = {entry.name for entry in entries if entry.is_file()}
+    except FileNotFoundError:
         return False
 
+    db_files = {"data.mdb", "lock.mdb"}
+    return db_files.issubset(files)
+
+
+# an environment must be opened only once per process and must not be used across fork,
+# so readers share one environment per (pid, path)
+_ENV_CACHE = {}
+_ENV_CACHE_LOCK = threading.Lock()
+
+
+def _get_shared_env(db_path: Path) -> lmdb.Environment:
+    key = (os.getpid(), db_path)
+    env = _ENV_CACHE.get(key)
+    if env is None:
+        with _ENV_CACHE_LOCK:
+            env = _ENV_CACHE.get(key)
+            if env is None:
+                env = _ENV_CACHE[key] = LMDBReadDict.get_env(db_path)
+    return env
+
 
 class LMDBReadDict:
     def __init__(self, db_path: Path) -> None:
@@ -43,78 +132,285 @@ class LMDBReadDict:
             raise RuntimeError(f"lmdb doesn't exists: {db_path}")
 
         self._db_path = Path(db_path).expanduser().resolve()
-        self._env = self.get_env(self._db_path)
+        self._len = None
+        # open right away, so an unreadable or incompatible database fails here and not on the first read
+        _check_format(_get_shared_env(self._db_path), self._db_path)
 
     def __getstate__(self):
         return self._db_path
 
     def __setstate__(self, path):
+        # the environment is opened lazily in the process which reads
         self._db_path = path
-        self._env = self.get_env(self._db_path)
+        self._len = None
+
+    @property
+    def _env(self) -> lmdb.Environment:
+        return _get_shared_env(self._db_path)
 
     def __len__(self):
-        env = self._env
-        return env.stat()["entries"]
+        # the database is read-only, so the number of entries is read once and only refresh() re-reads it
+        if self._len is None:
+            # all entries but the format marker
+            self._len = self._env.stat()["entries"] - 1
+        return self._len
 
     @staticmethod
     def get_env(db_path: Path):
+        # every read begins and ends its own transaction, ended ones are kept for reuse by the next begin(),
+        # which then renews one instead of allocating a new transaction
         env = lmdb.open(db_path.as_posix(),
                         subdir=True,
                         readonly=True,
                         lock=False,
                         readahead=False,
-                        meminit=False)
+                        meminit=False,
+                        max_spare_txns=32)
         return env
 
-    def _txn(self):
-        return self._env.begin()
+    def refresh(self) -> None:
+        """
+        Drops the cached number of entries, so len() counts entries committed since it was read.
+        Reads always see the latest committed data
+        """
+        self._len = None
 
     def __getitem__(self, index):
-        lmdb_data = self._txn().get(str(index).encode())
-        data = _deserialize(lmdb_data)
+        try:
+            key = _encode_key(index)
+        except struct.error:
+            # not a non-negative 64-bit integer, so it can't be stored either
+            raise KeyError(index) from None
+
+        # every read begins its own transaction: the environment is opened with lock=False, so writers can't see
+        # readers and a transaction kept open would read pages they reuse.
+        # buffers=True returns a memoryview into the memory map, so it is deserialized before the transaction ends
+        with self._env.begin(buffers=True) as txn:
+            lmdb_data = txn.get(key)
+            if lmdb_data is None:
+                raise KeyError(index)
+
+            data = _deserialize(lmdb_data)
+
+        return data
+
+    def map(self, indices: Iterable, num_workers: int = 5) -> list:
+        """
+        Reads values of indices with a pool of threads.
+        Threads share the environment of the process and LMDB releases the GIL while reading,
+        so there is no need to start processes and send every index and value between them
+        """
+        with ThreadPoolExecutor(num_workers) as executor:
+            return list(executor.map(self.__getitem__, indices))
+
+    def values(self) -> Iterator:
+        """
+        Yields all values in index order
+        """
+        # a single in-order cursor walk instead of a key lookup per item, keys are big-endian so it follows index order
+        with self._env.begin(buffers=True) as txn:
+            for key, value in txn.cursor():
+                # skip the format marker
+                if len(key) == _KEY_STRUCT.size:
+                    yield _deserialize(value)
+
+    def __iter__(self) -> Iterator:
+        return self.values()
+
+    def __getitems__(self, indices: list) -> list:
+        """
+        Batched __getitem__, used by PyTorch DataLoader to fetch a whole minibatch at once
+        """
+        # keys are fetched in sorted order, so a single cursor walks the B-tree forward
+        try:
+            order = sorted(range(len(indices)), key=indices.__getitem__)
+            keys = list(map(_encode_key, map(indices.__getitem__, order)))
+        except (TypeError, struct.error):
+            # some index is not a non-negative 64-bit integer, so it can't be stored either
+            for index in indices:
+                try:
+                    _encode_key(index)
+                except struct.error:
+                    raise KeyError(index) from None
+            raise
+
+        # one read transaction for the whole batch, values are views into it, so they are deserialized before it ends
+        with self._env.begin(buffers=True) as txn:
+            found = txn.cursor().getmulti(keys)
+            if len(found) != len(keys):
+                found_keys = {bytes(key) for key, _ in found}
+                missing = next(indices[i] for i, key in zip(order, keys) if key not in found_keys)
+                raise KeyError(missing)
+
+            data = [None] * len(indices)
+            for i, (_, value) in zip(order, found):
+                data[i] = _deserialize(value)
 
         return data
 
 
-def _get_data(key: int, value: Any):
-    return str(key).encode(), _serialize(value)
+# the writer uses writemap, which makes data.mdb as large as the map: start from the LMDB default (10 MiB)
+# and grow on MapFullError, a huge map has to be asked for explicitly
+_DEFAULT_MAP_SIZE = 10 * 1024**2
+
+
+def _estimate_map_size(value_sizes: list, length: int) -> int:
+    """
+    Estimates the map size needed to store length items from the sizes of some of their serialized values
+    """
+    if not value_sizes:
+        return 0
+
+    total = 0
+    for value_size in value_sizes:
+        # key, value and node header; values which don't fit a page go to whole overflow pages
+        size = _KEY_STRUCT.size + value_size + 16
+        if size > mmap.PAGESIZE // 2:
+            size = -(-size // mmap.PAGESIZE) * mmap.PAGESIZE
+        total += size
+
+    return int(total / len(value_sizes) * max(length, len(value_sizes)) * 1.1)
+
+
+def _serialize_chunk(items: list) -> list:
+    return list(map(_serialize, items))
 
 
-def _get_size(key: bytes, value: bytes):
-    return len(key) + len(value)
+def _serialize_items(iterable: Iterable, num_workers: int, chunk_bytes: int) -> Iterator[bytes]:
+    # values are produced one by one, so the caller decides how many of them are held in memory
+    if num_workers <= 0:
+        yield from map(_serialize, iterable)
+        return
 
+    # LMDB has a single writer, but serialization is independent per item: workers serialize the next chunks
+    # while the caller writes. Imported here, as it pulls in multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
 
-def dump2lmdb(db_path: Path, iterable: Iterable, size_multiplier=100, block_size=1024**2, overwrite: bool = False) -> Path:
+    it = iter(iterable)
+    chunk_size = 1
+    with ProcessPoolExecutor(num_workers) as executor:
+        # at most two chunks per worker are in flight, instead of a whole batch of items and their values
+        pending = deque()
+        while True:
+            while len(pending) < 2 * num_workers and (chunk := list(islice(it, chunk_size))):
+                pending.append(executor.submit(_serialize_chunk, chunk))
+            if not pending:
+                break
+
+            values = pending.popleft().result()
+            # the next chunks hold about chunk_bytes of serialized values, whatever the size of the items is
+            chunk_size = max(1, chunk_bytes * len(values) // max(1, sum(map(len, values))))
+            yield from values
+
+
+def _batched(values: Iterable[bytes], n: int, max_bytes: int) -> Iterator[list]:
+    # a batch ends at n values or at max_bytes of them, whichever comes first: large items are written
+    # in small batches, so a dump needs about max_bytes of memory whatever the size of the dataset is
+    batch = []
+    size = 0
+    for value in values:
+        batch.append(value)
+        size += len(value)
+        if len(batch) >= n or size >= max_bytes:
+            yield batch
+            batch = []
+            size = 0
+
+    if batch:
+        yield batch
+
+
+def _keyed_batches(batches: Iterable[list]) -> Iterator[list]:
+    index = 0
+    for batch in batches:
+        # keys of the whole batch are computed by C-level map/zip, without per-item Python calls
+        keys = map(_encode_key, range(index, index + len(batch)))
+        index += len(batch)
+        yield list(zip(keys, batch))
+
+
+def _put_batch(env: lmdb.Environment, items: list) -> None:
+    # one write transaction per batch: commit overhead is paid once, not once per item.
+    # Keys are ascending, so they are appended to the rightmost leaf without key comparisons
+    with env.begin(write=True) as txn:
+        cursor = txn.cursor()
+        consumed, added = cursor.putmulti(items, append=True)
+        if added != consumed:
+            # appending silently skips keys which are not greater than the last stored one,
+            # write the batch again with regular inserts
+            cursor.putmulti(items)
+
+
+def dump2lmdb(db_path: Path, iterable: Iterable, size_multiplier=100, block_size=1024**2, overwrite: bool = False,
+              batch_size: int = 10_000, num_workers: int = 0, map_size: Optional[int] = None) -> Path:
+    """
+    batch_size: maximal number of items written in one transaction. A batch also ends once its serialized values
+                take block_size * size_multiplier bytes, which bounds the memory a dump needs
+    num_workers: number of processes serializing items in parallel, 0 serializes in the calling process.
+                 Items are sent to the workers with pickle, so they have to be picklable
+    map_size: initial size of the memory map in bytes, it grows by block_size * size_multiplier when it is full.
+              Defaults to 10 MiB, or to an estimate from the first batch when the iterable's length is known
+              and needs more.
+              The writer uses writemap, so data.mdb is at least map_size bytes large (a sparse file on Linux)
+    """
     if overwrite:
+        # readers opened from now on must map the new files, and the mapping of the removed ones must not leak
+        with _ENV_CACHE_LOCK:
+            env = _ENV_CACHE.pop((os.getpid(), db_path.expanduser().resolve()), None)
+        if env is not None:
+            env.close()
         shutil.rmtree(db_path)
 
     if lmdb_exists(db_path):
+        # a cache written in another format must not be reused silently
+        resolved_path = db_path.expanduser().resolve()
+        _check_format(_get_shared_env(resolved_path), resolved_path)
         return db_path
-        
+
+    # inputs of known length get a map large enough for all items up front, instead of growing it while writing.
+    # The estimate is taken from the first serialized batch, so no item is loaded or serialized twice
+    length = length_hint(iterable) if map_size is None else 0
+
     db_path.mkdir(parents=True)
-    all_size = 0
-    open_lmdb = partial(lmdb.open, path=db_path.as_posix(), subdir=True, metasync=False, sync=False, writemap=True, map_async=True)
+    # writes go through the writable memory map and are flushed asynchronously, durability is ensured by
+    # a single forced sync once all items are written
+    open_lmdb = partial(lmdb.open, path=db_path.as_posix(), subdir=True, lock=True,
+                        metasync=False, sync=False, writemap=True, map_async=True)
+    env = None
     try:
-        env = open_lmdb()
-        for i, value in enumerate(iterable):
-            key, value = _get_data(i, value)
-            size = _get_size(key, value)
+        values = _serialize_items(iterable, num_workers, block_size)
+        batches = _keyed_batches(_batched(values, batch_size, block_size * size_multiplier))
+        # the format marker goes last, it also marks the dump as complete
+        for items in chain(batches, [[(_FORMAT_KEY, _FORMAT_VERSION)]]):
+            # sizes of the whole batch are computed by C-level map/sum, without per-item Python calls
+            size = sum(map(len, chain.from_iterable(items)))
+
+            if env is None:
+                if map_size is None:
+                    value_sizes = list(map(len, map(itemgetter(1), items)))
+                    map_size = max(_DEFAULT_MAP_SIZE, _estimate_map_size(value_sizes, length))
+                all_size = map_size
+                env = open_lmdb(map_size=all_size)
             all_size += size
 
-            try:
-                with env.begin(write=True) as txn:
-                    txn.put(key, value)
-            except lmdb.MapFullError:
-                # when LMDB reaches max size: close it, then reopenen with increased size
-                all_size += max(block_size, size) * size_multiplier
-                env.close()
+            while True:
+                try:
+                    _put_batch(env, items)
+                    break
+                except lmdb.MapFullError:
+                    # when LMDB reaches max size: close it, then reopen with increased size and retry the batch
+                    all_size += max(block_size, size) * size_multiplier
+                    env.close()
 
-                env = open_lmdb(map_size=all_size)
-                with env.begin(write=True) as txn:
-                    txn.put(key, value)
+                    env = open_lmdb(map_size=all_size)
 
+        env.sync(True)
         env.close()
     except Exception:
+        # unmap before removing: once the last mapping of a deleted file is gone,
+        # the kernel discards its dirty pages instead of writing them back
+        if env is not None:
+            env.close()
         shutil.rmtree(db_path)
         raise
 
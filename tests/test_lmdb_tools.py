@@ -1,7 +1,13 @@
 from pathlib import Path
+import lmdb
+import os
+import pickle
+import subprocess
+import sys
 import pytest
-from multiprocessing import Pool, Process, Value
-from lmdb_cache.lmdb_cache import _serialize, _deserialize, lmdb_exists, LMDBReadDict, dump2lmdb
+from multiprocessing import Pool, Process, Value, get_all_start_methods
+from lmdb_cache.lmdb_cache import (_serialize, _deserialize, _estimate_map_size, _batched, lmdb_exists,
+                                   LMDBReadDict, dump2lmdb)
 
 @pytest.fixture
 def setup_lmdb(tmp_path):
@@ -16,6 +22,19 @@ def test_serialize_deserialize():
     deserialized_obj = _deserialize(serialized_obj)
     assert obj == deserialized_obj
 
+def test_serialize_deserialize_bytes():
+    obj = bytes(range(256)) * 4
+    deserialized_obj = _deserialize(memoryview(_serialize(obj)))
+    assert type(deserialized_obj) is bytes
+    assert obj == deserialized_obj
+
+def test_serialize_deserialize_dill_fallback():
+    def func(x):
+        return x * 2
+
+    deserialized_func = _deserialize(_serialize(func))
+    assert deserialized_func(21) == 42
+
 def test_lmdb_exists(tmp_path):
     db_path = tmp_path / "lmdb_test"
     assert not lmdb_exists(db_path)
@@ -30,11 +49,66 @@ def test_lmdb_exists_not_a_directory(tmp_path):
     with pytest.raises(NotADirectoryError):
         lmdb_exists(db_file)
 
+WRITE_MAIN_SCRIPT = """
+import multiprocessing
+import sys
+from pathlib import Path
+from lmdb_cache import dump2lmdb
+
+class Point:
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+def norm(point):
+    return (point.x ** 2 + point.y ** 2) ** 0.5
+
+if __name__ == "__main__":
+    start_method = sys.argv[2]
+    if start_method == "none":
+        dump2lmdb(Path(sys.argv[1]), [Point(3, 4), norm])
+    else:
+        # workers of spawn and forkserver run this script as __mp_main__
+        multiprocessing.set_start_method(start_method)
+        dump2lmdb(Path(sys.argv[1]), [Point(3, 4), norm], num_workers=2)
+"""
+
+READ_MAIN_SCRIPT = """
+import sys
+from pathlib import Path
+from lmdb_cache import LMDBReadDict
+
+db = LMDBReadDict(Path(sys.argv[1]))
+point, norm = db[0], db[1]
+print(norm(point))
+"""
+
+@pytest.mark.parametrize("start_method", ["none", *get_all_start_methods()])
+def test_main_objects_across_processes(tmp_path, start_method):
+    # classes and functions of a script are stored by value, so another program can load them
+    db_path = tmp_path / "lmdb_main"
+    repo_root = Path(__file__).resolve().parent.parent
+    # spawn and forkserver workers import the main module from its file, so the script can't be passed with -c
+    write_script = tmp_path / "write_main.py"
+    write_script.write_text(WRITE_MAIN_SCRIPT)
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join([str(repo_root), os.environ.get("PYTHONPATH", "")])}
+    subprocess.run([sys.executable, str(write_script), str(db_path), start_method], cwd=repo_root, check=True, env=env)
+    result = subprocess.run([sys.executable, "-c", READ_MAIN_SCRIPT, str(db_path)], cwd=repo_root, check=True,
+                            capture_output=True, text=True)
+    assert result.stdout.strip() == "5.0"
+
 def test_LMDBReadDict_init(setup_lmdb):
     db_path, _ = setup_lmdb
     db = LMDBReadDict(db_path)
     assert isinstance(db, LMDBReadDict)
 
+def test_LMDBReadDict_pickle_shares_env(setup_lmdb):
+    db_path, data = setup_lmdb
+    db = LMDBReadDict(db_path)
+    restored = pickle.loads(pickle.dumps(db))
+    assert restored._env is db._env
+    assert restored[3] == data[3]
+
 def test_LMDBReadDict_len(setup_lmdb):
     db_path, data = setup_lmdb
     db = LMDBReadDict(db_path)
@@ -46,6 +120,58 @@ def test_LMDBReadDict_getitem(setup_lmdb):
     for key, value in data.items():
         assert db[key] == value
 
+def test_LMDBReadDict_iter(setup_lmdb):
+    db_path, data = setup_lmdb
+    db = LMDBReadDict(db_path)
+    assert list(db) == list(data.values())
+    assert list(db.values()) == list(data.values())
+
+def test_LMDBReadDict_getitems(setup_lmdb):
+    db_path, data = setup_lmdb
+    db = LMDBReadDict(db_path)
+    indices = [42, 7, 99, 7, 0]
+    assert db.__getitems__(indices) == [data[i] for i in indices]
+
+    with pytest.raises(KeyError):
+        db.__getitems__([1, len(data)])
+
+WRITE_UPDATES_SCRIPT = """
+import sys
+import lmdb
+from lmdb_cache.lmdb_cache import _encode_key, _serialize
+
+# every commit rewrites all values and adds one more entry
+env = lmdb.open(sys.argv[1], subdir=True)
+for version in range(1, int(sys.argv[2]) + 1):
+    with env.begin(write=True) as txn:
+        for i in range(int(sys.argv[3]) + 1):
+            txn.put(_encode_key(i), _serialize(f"data_{i}_v{version}"))
+env.close()
+"""
+
+def test_LMDBReadDict_refresh(tmp_path):
+    db_path = tmp_path / "lmdb_refresh"
+    size = 200
+    dump2lmdb(db_path, [f"data_{i}" for i in range(size)])
+    db = LMDBReadDict(db_path)
+    assert [db[i] for i in range(size)] == [f"data_{i}" for i in range(size)]
+    assert len(db) == size
+
+    # commit through a writer in another process, an environment must be opened only once per process
+    repo_root = Path(__file__).resolve().parent.parent
+    commits = 6
+    subprocess.run([sys.executable, "-c", WRITE_UPDATES_SCRIPT, db_path.as_posix(), str(commits), str(size)],
+                   cwd=repo_root, check=True)
+
+    # reads see the latest commit, the number of entries is re-read only after refresh()
+    expected = [f"data_{i}_v{commits}" for i in range(size + 1)]
+    assert [db[i] for i in range(size + 1)] == expected
+    assert db.__getitems__(list(range(size + 1))) == expected
+    assert len(db) == size
+
+    db.refresh()
+    assert len(db) == size + 1
+
 def test_dump2lmdb(tmp_path):
     db_path = tmp_path / "lmdb_dump"
     data = [f"data_{i}" for i in range(10)]
@@ -56,6 +182,69 @@ def test_dump2lmdb(tmp_path):
     for i, value in enumerate(data):
         assert db[i] == value
 
+def test_dump2lmdb_batches(tmp_path):
+    db_path = tmp_path / "lmdb_batches"
+    data = [f"data_{i}" for i in range(10)]
+    dump2lmdb(db_path, data, batch_size=3)
+
+    db = LMDBReadDict(db_path)
+    assert len(db) == len(data)
+    for i, value in enumerate(data):
+        assert db[i] == value
+
+def test_dump2lmdb_num_workers(tmp_path):
+    db_path = tmp_path / "lmdb_workers"
+    data = [{"index": i, "value": f"data_{i}"} for i in range(50)]
+    dump2lmdb(db_path, data, batch_size=7, num_workers=2)
+
+    db = LMDBReadDict(db_path)
+    assert len(db) == len(data)
+    for i, value in enumerate(data):
+        assert db[i] == value
+
+def test_batched_by_bytes():
+    values = [b"x" * 10] * 5
+    assert [len(batch) for batch in _batched(values, 100, 25)] == [3, 2]
+    assert [len(batch) for batch in _batched(values, 2, 1000)] == [2, 2, 1]
+
+def test_dump2lmdb_large_items(tmp_path):
+    # batches and worker chunks are bounded by bytes, so large items are written a few at a time
+    db_path = tmp_path / "lmdb_large"
+    data = [bytes([i]) * 4096 for i in range(30)]
+    dump2lmdb(db_path, data, block_size=1024, size_multiplier=8, num_workers=2)
+
+    db = LMDBReadDict(db_path)
+    assert len(db) == len(data)
+    for i, value in enumerate(data):
+        assert db[i] == value
+
+def test_estimate_map_size():
+    value_sizes = [100] * 16
+    assert _estimate_map_size(value_sizes, 1000) >= 1000 * 100
+    assert _estimate_map_size(value_sizes, 0) >= 16 * 100
+    assert _estimate_map_size([], 1000) == 0
+
+class CountingDataset:
+    def __init__(self, size):
+        self.size = size
+        self.loads = 0
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if index >= self.size:
+            raise IndexError(index)
+        self.loads += 1
+        return f"data_{index}"
+
+def test_dump2lmdb_loads_items_once(tmp_path):
+    db_path = tmp_path / "lmdb_once"
+    dataset = CountingDataset(50)
+    dump2lmdb(db_path, dataset)
+    assert dataset.loads == len(dataset)
+    assert len(LMDBReadDict(db_path)) == len(dataset)
+
 def test_dump2lmdb_cleanup_on_failure(tmp_path):
     db_path = tmp_path / "lmdb_fail"
     with pytest.raises(Exception):
@@ -74,15 +263,49 @@ def test_concurrent_reading(setup_lmdb):
     for key, result in zip(keys, results):
         assert data[key] == result
 
+    assert db.map(keys, 5) == results
+
+def test_concurrent_batch_reading(setup_lmdb):
+    db_path, data = setup_lmdb
+    db = LMDBReadDict(db_path)
+    keys = list(data.keys())
+    batches = [keys[i:i + 16] for i in range(0, len(keys), 16)]
+    with Pool(5) as p:
+        results = p.map(db.__getitems__, batches)
+
+    for batch, result in zip(batches, results):
+        assert [data[key] for key in batch] == result
+
 def test_LMDBReadDict_invalid_path():
     with pytest.raises(RuntimeError):  # Assuming RuntimeError for non-existent DB
         LMDBReadDict(Path("/path/to/nonexistent/db"))
 
 def test_LMDBReadDict_nonexistent_key(setup_lmdb):
+    db_path, data = setup_lmdb
+    db = LMDBReadDict(db_path)
+    with pytest.raises(KeyError):
+        _ = db[len(data)]
+
+@pytest.mark.parametrize("index", ["nonexistent_key", 1.0, -1, 1 << 64])
+def test_LMDBReadDict_invalid_key(setup_lmdb, index):
     db_path, _ = setup_lmdb
     db = LMDBReadDict(db_path)
-    with pytest.raises(EOFError):  # Assuming KeyError for non-existent key
-        _ = db['nonexistent_key']
+    with pytest.raises(KeyError):
+        _ = db[index]
+    with pytest.raises(KeyError):
+        db.__getitems__([0, index])
+
+def test_incompatible_format(tmp_path):
+    db_path = tmp_path / "lmdb_old"
+    env = lmdb.open(db_path.as_posix(), subdir=True)
+    with env.begin(write=True) as txn:
+        txn.put(b"0", b"data_0")
+    env.close()
+
+    with pytest.raises(RuntimeError):
+        LMDBReadDict(db_path)
+    with pytest.raises(RuntimeError):
+        dump2lmdb(db_path, ["data_0"])
 
 def test_LMDBReadDict_invalid_db_path_type():
     with pytest.raises(AttributeError):  # Adjust the exception type as needed